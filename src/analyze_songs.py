@@ -2,46 +2,36 @@ import argparse
 import contextlib
 import csv
 import io
+import json
 import os
+import subprocess
 import sys
-from typing import Dict, Iterable, List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import librosa
 import numpy as np
 
-SUPPORTED_FORMATS = {".mp3", ".wav", ".flac", ".m4a", ".aac"}
-KEY_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
-
-CAM_MAJOR = {
-    "B": "1B",
-    "F#": "2B",
-    "C#": "3B",
-    "G#": "4B",
-    "D#": "5B",
-    "A#": "6B",
-    "F": "7B",
-    "C": "8B",
-    "G": "9B",
-    "D": "10B",
-    "A": "11B",
-    "E": "12B",
-}
-
-CAM_MINOR = {
-    "G#": "1A",
-    "D#": "2A",
-    "A#": "3A",
-    "F": "4A",
-    "C": "5A",
-    "G": "6A",
-    "D": "7A",
-    "A": "8A",
-    "E": "9A",
-    "B": "10A",
-    "F#": "11A",
-    "C#": "12A",
-}
+try:
+    from .constants import CAM_MAJOR, CAM_MINOR, KEY_NAMES, is_supported_audio
+except ImportError:  # run as a script from src/
+    from constants import CAM_MAJOR, CAM_MINOR, KEY_NAMES, is_supported_audio
 
+FIELDNAMES = ["filename", "tempo_bpm", "camelot_key", "key", "error"]
+# Tempo and key need neither high frequencies nor the whole track.
+ANALYSIS_SR = 11025
+ANALYSIS_DURATION = 90.0
+# libsndfile (librosa's first choice) cannot decode AAC; these go straight to
+# ffmpeg instead of librosa's audioread fallback.
+FFMPEG_FORMATS = {".m4a", ".aac"}
+N_FFT = 2048
+HOP_LENGTH = 512
+# Bump ANALYSIS_ALGORITHM whenever analyze_song can produce different rows
+# for the same file; cached rows are only reused when CACHE_VERSION matches.
+ANALYSIS_ALGORITHM = 2
+CACHE_VERSION = (
+    f"{ANALYSIS_ALGORITHM}:{ANALYSIS_SR}:{ANALYSIS_DURATION}:{N_FFT}:{HOP_LENGTH}"
+)
 MAJOR_PROFILE = np.array(
     [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88],
     dtype=np.float32,
@@ -51,35 +41,45 @@ MINOR_PROFILE = np.array(
     dtype=np.float32,
 )
 
+# Built once for the fixed analysis rate; maps an STFT power spectrum to
+# 12 pitch classes (see analyze_song).
+CHROMA_FILTERBANK = librosa.filters.chroma(sr=ANALYSIS_SR, n_fft=N_FFT)
+
+# All 24 key profiles pre-rotated so key estimation is a single matmul.
+ROT_PROFILES = np.stack(
+    [np.roll(MAJOR_PROFILE, index) for index in range(12)]
+    + [np.roll(MINOR_PROFILE, index) for index in range(12)]
+).astype(np.float32)
+KEY_LABELS = [f"{name} major" for name in KEY_NAMES] + [
+    f"{name} minor" for name in KEY_NAMES
+]
+CAMELOT_LABELS = [CAM_MAJOR[name] for name in KEY_NAMES] + [
+    CAM_MINOR[name] for name in KEY_NAMES
+]
+
 
 def list_songs(directory: str) -> List[str]:
-    return [
-        os.path.join(directory, filename)
-        for filename in os.listdir(directory)
-        if os.path.isfile(os.path.join(directory, filename))
-        and os.path.splitext(filename)[1].lower() in SUPPORTED_FORMATS
-    ]
+    with os.scandir(directory) as entries:
+        return [
+            entry.path
+            for entry in entries
+            if entry.is_file() and is_supported_audio(entry.name)
+        ]
 
 
-def estimate_key(chroma: np.ndarray) -> str:
-    chroma_mean = chroma.mean(axis=1)
+def estimate_key_index(chroma: np.ndarray) -> int:
+    # Accepts a (12, T) chromagram or an already aggregated 12-bin profile
+    if chroma.ndim > 1:
+        chroma_mean = chroma.mean(axis=1, dtype=np.float32)
+    else:
+        chroma_mean = chroma.astype(np.float32, copy=False)
     chroma_norm = chroma_mean / (np.linalg.norm(chroma_mean) + 1e-9)
 
-    best_score = float("-inf")
-    best_key = "Unknown"
-
-    for index, key_name in enumerate(KEY_NAMES):
-        major_score = np.dot(chroma_norm, np.roll(MAJOR_PROFILE, index))
-        if major_score > best_score:
-            best_score = major_score
-            best_key = f"{key_name} major"
+    return int((ROT_PROFILES @ chroma_norm).argmax())
 
-        minor_score = np.dot(chroma_norm, np.roll(MINOR_PROFILE, index))
-        if minor_score > best_score:
-            best_score = minor_score
-            best_key = f"{key_name} minor"
 
-    return best_key
+def estimate_key(chroma: np.ndarray) -> str:
+    return KEY_LABELS[estimate_key_index(chroma)]
 
 
 def key_to_camelot(key: str) -> str:
@@ -95,53 +95,159 @@ def key_to_camelot(key: str) -> str:
     return ""
 
 
-def analyze_song(path: str) -> Dict[str, str]:
+def load_with_ffmpeg(path: str) -> np.ndarray:
+    # ffmpeg decodes, downmixes and resamples in one pass
+    result = subprocess.run(
+        [
+            "ffmpeg", "-v", "error", "-t", str(ANALYSIS_DURATION), "-i", path,
+            "-ac", "1", "-ar", str(ANALYSIS_SR), "-f", "f32le", "-",
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode(errors="replace").strip())
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+
+def load_audio(path: str) -> Tuple[np.ndarray, int]:
+    if os.path.splitext(path)[1].lower() in FFMPEG_FORMATS:
+        try:
+            return load_with_ffmpeg(path), ANALYSIS_SR
+        except FileNotFoundError:
+            pass  # ffmpeg not installed; let librosa/audioread try
+
     # Suppress low-level mpg123 C library stderr warnings for malformed MP3 tags
     stderr_fd = sys.stderr.fileno()
     with open(os.devnull, 'w') as devnull:
         old_stderr = os.dup(stderr_fd)
         os.dup2(devnull.fileno(), stderr_fd)
         try:
-            y, sr = librosa.load(path, mono=True)
+            return librosa.load(
+                path,
+                sr=ANALYSIS_SR,
+                mono=True,
+                duration=ANALYSIS_DURATION,
+                res_type="soxr_lq",
+            )
         finally:
             os.dup2(old_stderr, stderr_fd)
             os.close(old_stderr)
-    
-    tempo = librosa.feature.tempo(y=y, sr=sr, aggregate=None)
-    tempo_value = float(np.median(tempo)) if tempo.size else 0.0
-    chroma = librosa.feature.chroma_stft(y=y, sr=sr)
-    key = estimate_key(chroma)
-    camelot_key = key_to_camelot(key)
+
+
+def analyze_song(path: str) -> Dict[str, str]:
+    y, sr = load_audio(path)
+
+    # One power spectrogram feeds both the onset envelope and the chroma.
+    S = np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH)) ** 2
+    onset_env = librosa.onset.onset_strength(
+        S=librosa.power_to_db(S), sr=sr, hop_length=HOP_LENGTH
+    )
+    # A single global estimate over the whole onset envelope
+    tempo = librosa.feature.tempo(
+        onset_envelope=onset_env, sr=sr, hop_length=HOP_LENGTH
+    )
+    tempo_value = float(tempo[0])
+    # Applying the filterbank to the time-summed spectrum yields the summed
+    # chroma profile without materializing the 12 x T chromagram; the
+    # missing 1/T does not change the normalized key scores.
+    chroma_profile = CHROMA_FILTERBANK @ S.sum(axis=1)
+    key_index = estimate_key_index(chroma_profile)
 
     return {
         "filename": os.path.basename(path),
         "tempo_bpm": str(int(round(tempo_value))),
-        "camelot_key": camelot_key,
-        "key": key,
+        "camelot_key": CAMELOT_LABELS[key_index],
+        "key": KEY_LABELS[key_index],
     }
 
 
-def analyze_folder(directory: str) -> Iterable[Dict[str, str]]:
+def analyze_song_safe(path: str) -> Dict[str, str]:
+    # Runs inside worker processes; errors are returned as rows because
+    # exceptions from librosa/audioread do not always pickle cleanly.
+    try:
+        return analyze_song(path)
+    except Exception as exc:
+        return {
+            "filename": os.path.basename(path),
+            "tempo_bpm": "",
+            "camelot_key": "",
+            "key": "",
+            "error": str(exc),
+        }
+
+
+def load_cache(cache_path: str) -> Dict[str, Any]:
+    # Missing, unreadable, malformed or outdated caches all count as empty
+    try:
+        with open(cache_path) as handle:
+            cache = json.load(handle)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+        return {}
+    entries = cache.get("entries")
+    return entries if isinstance(entries, dict) else {}
+
+
+def save_cache(entries: Dict[str, Any], cache_path: str) -> None:
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as handle:
+        json.dump({"version": CACHE_VERSION, "entries": entries}, handle)
+    os.replace(tmp_path, cache_path)
+
+
+def analyze_folder(
+    directory: str, cache_path: Optional[str] = None
+) -> Iterable[Dict[str, str]]:
+    # Rows are cached per absolute path and reused while the file's size and
+    # mtime are unchanged; only the remaining files are sent to the pool.
+    cache = load_cache(cache_path) if cache_path else {}
+    updated_cache: Dict[str, Any] = {}
+    plan = []
+    pending = []
     for song_path in list_songs(directory):
-        try:
-            yield analyze_song(song_path)
-        except Exception as exc:
-            yield {
-                "filename": os.path.basename(song_path),
-                "tempo_bpm": "",
-                "camelot_key": "",
-                "key": "",
-                "error": str(exc),
-            }
-
-
-def write_csv(rows: Iterable[Dict[str, str]], output_path: str) -> None:
-    fieldnames = ["filename", "tempo_bpm", "camelot_key", "key", "error"]
+        cache_key = os.path.abspath(song_path)
+        stat = os.stat(song_path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        entry = cache.get(cache_key)
+        if (
+            isinstance(entry, dict)
+            and entry.get("signature") == signature
+            and isinstance(entry.get("row"), dict)
+        ):
+            updated_cache[cache_key] = entry
+            plan.append((cache_key, signature, entry["row"]))
+        else:
+            plan.append((cache_key, signature, None))
+            pending.append(song_path)
+
+    try:
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            fresh_rows = executor.map(analyze_song_safe, pending, chunksize=1)
+            for cache_key, signature, row in plan:
+                if row is None:
+                    row = next(fresh_rows)
+                    if "error" not in row:
+                        updated_cache[cache_key] = {"signature": signature, "row": row}
+                yield row
+    finally:
+        if cache_path:
+            save_cache(updated_cache, cache_path)
+
+
+def write_csv(rows: Iterable[Dict[str, str]], output_path: str) -> int:
+    # Rows are written and flushed as they arrive so partial results
+    # survive an interrupted run; returns the number of rows written.
+    count = 0
     with open(output_path, "w", newline="") as handle:
-        writer = csv.DictWriter(handle, fieldnames=fieldnames)
+        writer = csv.DictWriter(handle, fieldnames=FIELDNAMES)
         writer.writeheader()
         for row in rows:
             writer.writerow(row)
+            handle.flush()
+            count += 1
+    return count
 
 
 def parse_args() -> argparse.Namespace:
@@ -163,11 +269,18 @@ def parse_args() -> argparse.Namespace:
         default=default_output,
         help=f"CSV file path for results (default: {default_output})",
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Re-analyze every file instead of reusing cached results",
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_args()
-    results = list(analyze_folder(args.directory))
-    write_csv(results, args.output)
-    print(f"Wrote {len(results)} rows to {args.output}")
+    cache_path = None
+    if not args.no_cache:
+        cache_path = os.path.splitext(args.output)[0] + ".cache.json"
+    count = write_csv(analyze_folder(args.directory, cache_path), args.output)
+    print(f"Wrote {count} rows to {args.output}")
@@ -0,0 +1,52 @@
+SUPPORTED_FORMATS = {".mp3", ".wav", ".flac", ".m4a", ".aac"}
+# Same extensions as a tuple for str.endswith
+SUPPORTED_EXTENSIONS = tuple(sorted(SUPPORTED_FORMATS))
+# Explicit types so playback does not depend on the platform's mime.types
+AUDIO_MIMETYPES = {
+    ".mp3": "audio/mpeg",
+    ".wav": "audio/wav",
+    ".flac": "audio/flac",
+    ".m4a": "audio/mp4",
+    ".aac": "audio/aac",
+}
+
+KEY_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+
+CAM_MAJOR = {
+    "B": "1B",
+    "F#": "2B",
+    "C#": "3B",
+    "G#": "4B",
+    "D#": "5B",
+    "A#": "6B",
+    "F": "7B",
+    "C": "8B",
+    "G": "9B",
+    "D": "10B",
+    "A": "11B",
+    "E": "12B",
+}
+
+CAM_MINOR = {
+    "G#": "1A",
+    "D#": "2A",
+    "A#": "3A",
+    "F": "4A",
+    "C": "5A",
+    "G": "6A",
+    "D": "7A",
+    "A": "8A",
+    "E": "9A",
+    "B": "10A",
+    "F#": "11A",
+    "C#": "12A",
+}
+
+
+def is_supported_audio(name: str) -> bool:
+    """Whether a file name has one of the SUPPORTED_FORMATS extensions.
+
+    Leading dots are ignored, as os.path.splitext does, so a hidden file
+    named just '.mp3' has no extension and is not audio.
+    """
+    return name.lstrip(".").lower().endswith(SUPPORTED_EXTENSIONS)
@@ -1,57 +1,178 @@
+import gzip
+import hashlib
 import os
+import threading
 import webbrowser
-from flask import Flask, render_template, send_file
-from threading import Timer
+from typing import Dict, List, NamedTuple, Optional
+from flask import Flask, Response, abort, render_template, request, send_file
+from urllib.parse import quote
+from werkzeug.serving import make_server
 
-app = Flask(__name__)
+try:
+    from .constants import AUDIO_MIMETYPES, is_supported_audio
+except ImportError:  # run as a script from src/
+    from constants import AUDIO_MIMETYPES, is_supported_audio
+
+try:
+    import brotli
+except ImportError:  # optional; the index page is still served gzipped
+    brotli = None
+
+try:
+    from waitress import create_server
+except ImportError:  # optional; fall back to Werkzeug's development server
+    create_server = None
+
+# No static files are served, so skip registering the /static route
+app = Flask(__name__, static_folder=None)
+# Behind Apache/lighttpd with mod_xsendfile, set MIXBUDDY_X_SENDFILE=1 so
+# audio responses carry an X-Sendfile header and the front server streams
+# the file instead of Python.
+app.config['USE_X_SENDFILE'] = os.environ.get('MIXBUDDY_X_SENDFILE') == '1'
+# Behind nginx, set MIXBUDDY_ACCEL_REDIRECT to an `internal` location that
+# aliases the songs folder (e.g. /internal_songs/); /play/ then answers with
+# an empty X-Accel-Redirect response and nginx sends the file itself.
+ACCEL_REDIRECT_PREFIX = os.environ.get('MIXBUDDY_ACCEL_REDIRECT')
 
 # Get songs directory
 src_dir = os.path.dirname(os.path.abspath(__file__))
 MUSIC_DIR = os.path.normpath(os.path.join(src_dir, "..", "songs"))
 
 
+class SongScan(NamedTuple):
+    """One cached scan of a music directory"""
+    mtime: int  # directory st_mtime_ns at scan time
+    songs: List[str]  # song names, sorted case-insensitively
+    paths: Dict[str, str]  # song name -> full path
+
+
+# Maps directory -> SongScan; rescanned only when the directory's mtime
+# changes, i.e. when files are added, removed or renamed.
+_song_cache = {}
+
+
 def get_songs(directory: str) -> list:
     """Get list of supported audio files from directory"""
-    supported_formats = {'.mp3', '.wav', '.flac', '.m4a', '.aac'}
-    
-    if not os.path.exists(directory):
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
         return []
     
-    songs = [
-        f for f in os.listdir(directory)
-        if os.path.isfile(os.path.join(directory, f))
-        and os.path.splitext(f)[1].lower() in supported_formats
-    ]
-    return sorted(songs, key=lambda x: x.lower())
+    cached = _song_cache.get(directory)
+    if cached is not None and cached.mtime == mtime:
+        return cached.songs
+    
+    with os.scandir(directory) as entries:
+        paths = {
+            entry.name: entry.path for entry in entries
+            if entry.is_file() and is_supported_audio(entry.name)
+        }
+    songs = sorted(paths, key=str.lower)
+    _song_cache[directory] = SongScan(mtime, songs, paths)
+    return songs
+
+
+def get_song_path(directory: str, filename: str) -> Optional[str]:
+    """Full path of a song in directory's song list, or None"""
+    get_songs(directory)
+    cached = _song_cache.get(directory)
+    return cached.paths.get(filename) if cached is not None else None
+
+
+# (song list it was rendered from, {encoding: body}, etag); get_songs returns
+# the same list object until the directory changes, so the page is rendered
+# and compressed once per change instead of once per request.
+_index_page = None
 
 
 @app.route('/')
 def index():
     """Main page showing song list"""
+    global _index_page
     songs = get_songs(MUSIC_DIR)
-    return render_template('index.html', songs=songs)
+    if _index_page is None or _index_page[0] is not songs:
+        body = render_template('index.html', songs=songs).encode()
+        bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9)}
+        if brotli is not None:
+            bodies['br'] = brotli.compress(body, quality=11)
+        etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+        _index_page = (songs, bodies, etag)
+    
+    _, bodies, etag = _index_page
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in bodies and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    
+    if encoding != 'identity':
+        etag = f'{etag}-{encoding}'
+    
+    # If-None-Match uses weak comparison (RFC 7232, section 3.2)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(bodies[encoding], mimetype='text/html')
+        if encoding != 'identity':
+            response.content_encoding = encoding
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response
 
 
 @app.route('/play/<path:filename>')
 def play_song(filename):
     """Serve audio file for playback"""
-    song_path = os.path.join(MUSIC_DIR, filename)
-    if os.path.exists(song_path):
-        return send_file(song_path)
-    return "File not found", 404
+    # Only names from the song list are served, which rules out path
+    # traversal without an extra stat per request
+    song_path = get_song_path(MUSIC_DIR, filename)
+    if song_path is None:
+        abort(404)
+    
+    mimetype = AUDIO_MIMETYPES.get(
+        os.path.splitext(filename)[1].lower(), 'application/octet-stream'
+    )
+    if ACCEL_REDIRECT_PREFIX:
+        return Response(headers={
+            'X-Accel-Redirect': ACCEL_REDIRECT_PREFIX + quote(filename),
+            'Content-Type': mimetype,
+        })
+    
+    # conditional=True answers Range / If-None-Match requests with 206 / 304
+    response = send_file(
+        song_path,
+        mimetype=mimetype,
+        conditional=True,
+        etag=True,
+        max_age=31536000,
+    )
+    # A song's content does not change under the same name
+    response.cache_control.immutable = True
+    return response
 
 
 def open_browser():
-    """Open browser after a short delay"""
+    """Open the player in the default browser"""
     webbrowser.open('http://127.0.0.1:8080')
 
 
 if __name__ == "__main__":
-    # Open browser automatically after starting server
-    Timer(1, open_browser).start()
+    # Bind the socket before opening the browser, so its first request
+    # waits in the listen queue instead of racing the server start-up.
+    # The browser is opened from a thread because console browsers block
+    # webbrowser.open until they exit, which would stall the serve loop.
+    if create_server is not None:
+        server = create_server(app, host='127.0.0.1', port=8080, threads=16)
+        serve_forever = server.run
+    else:
+        server = make_server('127.0.0.1', 8080, app, threaded=True)
+        serve_forever = server.serve_forever
     
     print("Starting MixBuddy...")
     print("Opening browser at http://127.0.0.1:8080")
     print("Press Ctrl+C to quit")
     
-    app.run(debug=False, port=8080)
\ No newline at end of file
+    threading.Thread(target=open_browser, daemon=True).start()
+    serve_forever()